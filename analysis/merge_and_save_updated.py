@@ -1,42 +1,189 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import os
 import pandas as pd
 from pathlib import Path
 import shutil
 import sys
 
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+    import pyarrow.parquet as pq
+except ImportError:  # optional: fall back to pandas' CSV writer
+    pa = None
+
 # Paths
 ROOT = Path(__file__).resolve().parents[1]
 ANALYSIS_DIR = Path(__file__).resolve().parent
 
+# Accepted date column names, lower-case
+DATE_COLUMN_NAMES = frozenset({'date', 'datum'})
+
+
+def lower_column_map(df):
+    # lower-case name -> original name, in column order; first one wins on clashes
+    low = {}
+    for c in df.columns:
+        low.setdefault(c.lower(), c)
+    return low
+
 
 def find_date_column(df):
-    candidates = ['date', 'datum', 'Datum', 'DATUM']
     for c in df.columns:
-        if c.lower() in [x.lower() for x in candidates]:
+        if c.lower() in DATE_COLUMN_NAMES:
             return c
     return None
 
 
-def read_and_normalize(path):
-    df = pd.read_csv(path)
-    date_col = find_date_column(df)
+# Parse-time dtypes, keyed by lower-case column name
+COLUMN_DTYPES = {
+    'bewoelkung': 'Int16',
+    'windgeschwindigkeit': 'Int16',
+    'wettercode': 'Int16',
+    'kielerwoche': 'Int8',
+    'id': 'Int64',
+    'warengruppe': 'Int8',
+}
+
+# Origin of the integer date_key used for per-date lookups
+DATE_EPOCH = pd.Timestamp('2013-01-01')
+
+# Sales rows widened and written per chunk
+SALES_CHUNK_ROWS = 500_000
+
+# Output file buffer and rows per to_csv batch (pandas writer)
+WRITE_BUFFER_BYTES = 1 << 20
+CSV_WRITE_ROWS = 200_000
+
+
+def read_and_normalize(path, usecols=None):
+    # read the header only to find the date column and the columns we need
+    header = pd.read_csv(path, nrows=0)
+    date_col = find_date_column(header)
     if date_col is None:
         raise ValueError(f"No date column found in {path}")
-    df[date_col] = pd.to_datetime(df[date_col], dayfirst=False, errors='coerce')
+
+    cols = list(header.columns)
+    if usecols is not None:
+        # same substring match as find_column, so renamed variants are kept
+        wanted = [c.lower() for c in usecols]
+        cols = [c for c in cols
+                if c == date_col or any(k in c.strip().lower() for k in wanted)]
+    dtypes = {c: COLUMN_DTYPES[c.strip().lower()] for c in cols
+              if c.strip().lower() in COLUMN_DTYPES}
+
+    df = pd.read_csv(path, usecols=cols, dtype=dtypes, parse_dates=[date_col],
+                     dayfirst=False, cache_dates=True)
+    if not pd.api.types.is_datetime64_any_dtype(df[date_col]):
+        # a non-date row (e.g. a label line) makes the parser keep strings
+        df[date_col] = pd.to_datetime(df[date_col], errors='coerce')
     df = df.rename(columns={date_col: 'date'})
-    df = df.rename(columns={c: c.strip() for c in df.columns})
+    df.columns = df.columns.str.strip()
+    assert df.columns.is_unique, 'column names clash after stripping whitespace'
     return df
 
 
+def add_date_key(df):
+    # day ordinal as a narrow lookup key; NaT dates get <NA>; returns a new frame
+    return df.assign(date_key=(df['date'] - DATE_EPOCH).dt.days.astype('Int32'))
+
+
+def dense_day_table(*frames):
+    # per-date frames -> one dense table where row i holds date_key first_key + i;
+    # one extra all-NA row at the end stands in for dates outside the range
+    keyed = [add_date_key(f).dropna(subset=['date_key']).drop(columns=['date']).set_index('date_key')
+             for f in frames]
+    for f in keyed:
+        if not f.index.is_unique:
+            raise ValueError('Duplicate dates in a per-date lookup file')
+    # frames without any valid date only contribute all-NA columns
+    filled = [f for f in keyed if len(f)]
+    first_key = min((int(f.index.min()) for f in filled), default=0)
+    last_key = max((int(f.index.max()) for f in filled), default=first_key - 1)
+    days = pd.RangeIndex(first_key, last_key + 2)
+    dense = pd.concat([f.reindex(days) for f in keyed], axis=1)
+    return first_key, dense.reset_index(drop=True)
+
+
 def find_column(df, keywords):
     kws = [k.lower() for k in keywords]
-    for c in df.columns:
-        lc = c.lower()
-        for k in kws:
-            if k in lc:
-                return c
+    for lc, c in lower_column_map(df).items():
+        if any(k in lc for k in kws):
+            return c
     return None
 
 
+def csv_dates(table):
+    # write plain dates like pandas does, not full timestamps
+    if 'date' not in table.column_names:
+        return table
+    i = table.column_names.index('date')
+    return table.set_column(i, 'date', table.column('date').cast(pa.date32()))
+
+
+def plain_int_columns(df):
+    # nullable ints without missing values -> numpy ints, so to_csv can
+    # skip the extension-array formatter; columns with <NA> are left as is
+    casts = {c: df[c].dtype.numpy_dtype for c in df.columns
+             if isinstance(df[c].dtype, pd.api.extensions.ExtensionDtype)
+             and pd.api.types.is_integer_dtype(df[c].dtype) and not df[c].hasnans}
+    return df.astype(casts) if casts else df
+
+
+def write_csv_chunks(chunks, path, parquet_path=None):
+    # chunks: iterable of DataFrames with identical columns, written in order;
+    # with parquet_path (pyarrow only) each chunk also becomes a row group there.
+    # Written to temp files first, so a failed run never leaves a partial output.
+    if pa is None and parquet_path is not None:
+        print(f'pyarrow not installed, skipping {parquet_path.name}')
+        parquet_path = None
+    targets = [p for p in (path, parquet_path) if p is not None]
+    tmp_paths = [p.with_name(p.name + '.tmp') for p in targets]
+    try:
+        _write_chunks(chunks, *tmp_paths)
+        for tmp, target in zip(tmp_paths, targets):
+            os.replace(tmp, target)
+    except BaseException:
+        for tmp in tmp_paths:
+            tmp.unlink(missing_ok=True)
+        raise
+
+
+def _write_chunks(chunks, path, parquet_path=None):
+    if pa is None:
+        with open(path, 'wb', buffering=WRITE_BUFFER_BYTES) as fh:
+            for i, chunk in enumerate(chunks):
+                chunk = plain_int_columns(chunk)
+                chunk.to_csv(fh, header=(i == 0), index=False, na_rep='NaN',
+                             chunksize=CSV_WRITE_ROWS, lineterminator='\n')
+        return
+    options = pacsv.WriteOptions(include_header=True, null_string='NaN',
+                                 quoting_header='none')
+    writer = pq_writer = schema = None
+    sink = pa.output_stream(path, buffer_size=WRITE_BUFFER_BYTES)
+    try:
+        for chunk in chunks:
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            if writer is None:
+                schema = table.schema
+                writer = pacsv.CSVWriter(sink, csv_dates(table).schema, write_options=options)
+                if parquet_path is not None:
+                    pq_writer = pq.ParquetWriter(parquet_path, schema, compression='snappy')
+            else:
+                # all-NA chunks may infer a different type; align with the first
+                table = table.cast(schema)
+            writer.write_table(csv_dates(table))
+            if pq_writer is not None:
+                pq_writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+        if pq_writer is not None:
+            pq_writer.close()
+        sink.close()
+
+
 def standardize_sales_df(df):
     # id
     id_col = find_column(df, ['id'])
@@ -53,50 +200,90 @@ def standardize_sales_df(df):
     if u_col:
         if u_col != 'umsatz':
             df = df.rename(columns={u_col: 'umsatz'})
-        df['umsatz'] = pd.to_numeric(df['umsatz'].astype(str).str.replace(',', '.'), errors='coerce')
+        col = df['umsatz']
+        if not pd.api.types.is_numeric_dtype(col):
+            col = col.str.replace(',', '.', regex=False)
+        df['umsatz'] = pd.to_numeric(col, errors='coerce')
     else:
-        df['umsatz'] = pd.NA
+        # float NaN keeps umsatz numeric when concatenated with real sales
+        df['umsatz'] = float('nan')
 
     # ensure id exists
     if 'id' not in df.columns:
         df['id'] = pd.NA
 
-    df = df.rename(columns={c: c.strip() for c in df.columns})
+    df.columns = df.columns.str.strip()
+    assert df.columns.is_unique, 'column names clash after stripping whitespace'
     return df
 
 
-def main():
+def merge_features(sales, first_key, day_table, school_dates, public_dates):
+    # gather the per-date features by row position instead of a hash join
+    missing = len(day_table) - 1
+    pos = (sales['date_key'] - first_key).to_numpy(dtype='int64', na_value=-1)
+    pos[(pos < 0) | (pos > missing)] = missing
+    merged = pd.concat([sales.drop(columns=['date_key']).reset_index(drop=True),
+                        day_table.take(pos).reset_index(drop=True)], axis=1)
+
+    # holiday flags as int8: a hash lookup into the (small) holiday date sets
+    merged['school_holiday'] = merged['date'].isin(school_dates).astype('int8')
+    merged['public_holiday'] = merged['date'].isin(public_dates).astype('int8')
+
+    # Convert selected columns to small nullable ints in one pass
+    # (cloud cover 0-8, wind 0-100, kiwo 0/1)
+    int_cols = {'Bewoelkung': 'Int16', 'Windgeschwindigkeit': 'Int16', 'KielerWoche': 'Int8'}
+    merged = merged.astype({c: t for c, t in int_cols.items() if c in merged.columns})
+
+    # Column order
+    preferred = ['date', 'warengruppe', 'id', 'umsatz',
+                 'Bewoelkung', 'Temperatur', 'Windgeschwindigkeit', 'Wettercode',
+                 'KielerWoche', 'school_holiday', 'public_holiday']
+    cols_order = [c for c in preferred if c in merged.columns] + \
+                 [c for c in merged.columns if c not in preferred]
+    return merged[cols_order]
+
+
+def main(force=False):
     umsatz_path = ROOT / 'umsatzdaten_gekuerzt.csv'
     wetter_path = ROOT / 'wetter.csv'
     kiwo_path = ROOT / 'kiwo.csv'
-    test_path = ANALYSIS_DIR / 'test.csv'
-
-    print('Reading base files...')
-    umsatz = read_and_normalize(umsatz_path)
-    wetter = read_and_normalize(wetter_path)
-    kiwo = read_and_normalize(kiwo_path)
-
-    # --- NEW: read holidays ---
     school_path = ROOT / 'Ferien_SH.csv'
     public_path = ROOT / 'Feiertage_holidays_sh_2013_2019.csv'
+    test_path = ANALYSIS_DIR / 'test.csv'
+    out_path = ANALYSIS_DIR / 'merged_data_updated.csv'
 
-    school = read_and_normalize(school_path)
-    public = read_and_normalize(public_path)
+    parquet_path = out_path.with_suffix('.parquet')
 
-    # School holidays → holiday = 1
-    school['school_holiday'] = 1
-    school = school[['date', 'school_holiday']]
+    # Skip the run if every output is newer than every input (and this script)
+    inputs = [umsatz_path, wetter_path, kiwo_path, school_path, public_path, Path(__file__)]
+    if test_path.exists():
+        inputs.append(test_path)
+    outputs = [out_path] + ([parquet_path] if pa is not None else [])
+    if not force and all(p.exists() for p in outputs) and \
+            min(p.stat().st_mtime for p in outputs) > max(p.stat().st_mtime for p in inputs):
+        print(f'Cache hit: {out_path} is up to date (use --force to rebuild)')
+        return
 
-    # Public holidays already 1/0 → rename
-    public = public.rename(columns={'is_holiday': 'public_holiday'})
-    public = public[['date', 'public_holiday']]
+    print('Reading base files...')
+    # independent reads; the C parser releases the GIL, so threads overlap them
+    paths = [umsatz_path, wetter_path, kiwo_path, school_path, public_path]
+    usecols = [['id', 'wareng', 'umsatz'], None, ['KielerWoche'], [], ['is_holiday']]
+    with ThreadPoolExecutor(max_workers=len(paths)) as ex:
+        umsatz, wetter, kiwo, school, public = ex.map(read_and_normalize, paths, usecols)
+
+    # --- NEW: holidays ---
+    # School holidays → every listed date is a holiday
+    school_dates = pd.Index(school['date'].dropna().unique())
+
+    # Public holidays already 1/0 → keep the dates flagged 1
+    public_dates = pd.Index(public.loc[public['is_holiday'] == 1, 'date'].dropna().unique())
     # --- END NEW ---
 
     # prepare sales: optionally append continuation from analysis/test.csv
     umsatz = standardize_sales_df(umsatz)
     if test_path.exists():
         print(f'Appending continuation file: {test_path.name}')
-        test_df = read_and_normalize(test_path)
+        test_df = read_and_normalize(test_path, usecols=['id', 'wareng', 'umsatz'])
         test_df = standardize_sales_df(test_df)
 
         desired_cols = ['date', 'id', 'warengruppe', 'umsatz']
@@ -106,67 +293,48 @@ def main():
             if c not in test_df.columns:
                 test_df[c] = pd.NA
 
-        umsatz.replace('', pd.NA, inplace=True)
-        test_df.replace('', pd.NA, inplace=True)
-
         combined_sales = pd.concat([umsatz[desired_cols], test_df[desired_cols]], ignore_index=True)
         combined_sales['date'] = pd.to_datetime(combined_sales['date'], errors='coerce')
-        combined_sales['_id_sort'] = combined_sales['id'].astype(str).fillna('')
-        combined_sales = combined_sales.sort_values(by=['date', '_id_sort'], na_position='last').drop(columns=['_id_sort'])
+        combined_sales['id'] = pd.to_numeric(combined_sales['id'], errors='coerce').astype('Int64')
+        combined_sales = combined_sales.sort_values(by=['date', 'id'], na_position='last', kind='stable')
         combined_sales = combined_sales[desired_cols]
 
         umsatz = combined_sales
         print(f'Combined sales rows: {len(umsatz)}')
 
-    # ensure umsatz numeric
-    if 'umsatz' in umsatz.columns:
-        umsatz['umsatz'] = pd.to_numeric(umsatz['umsatz'].astype(str).str.replace(',', '.'), errors='coerce')
-    else:
-        umsatz['umsatz'] = pd.NA
-
-    # Merge
-    print('Merging with weather and kiwo (left join on date)...')
-    merged = umsatz.merge(wetter, on='date', how='left')
-    merged = merged.merge(kiwo, on='date', how='left')
+    # Per-date lookups: weather + kiwo as a dense day table, holidays as flags
+    print('Merging with weather, kiwo and holidays (lookup by date)...')
+    first_key, day_table = dense_day_table(wetter, kiwo)
 
-    # --- NEW: merge holiday data ---
-    merged = merged.merge(school, on='date', how='left')
-    merged = merged.merge(public, on='date', how='left')
-
-    merged['school_holiday'] = merged['school_holiday'].fillna(0).astype('Int64')
-    merged['public_holiday'] = merged['public_holiday'].fillna(0).astype('Int64')
-    # --- END NEW ---
-
-    # Convert selected columns to nullable int
-    int_cols = ['Bewoelkung', 'Windgeschwindigkeit', 'KielerWoche']
-    for c in int_cols:
-        if c in merged.columns:
-            merged[c] = pd.to_numeric(merged[c], errors='coerce').round(0).astype('Int64')
-
-    # Reorder rows
-    sort_keys = [k for k in ['date', 'warengruppe', 'id'] if k in merged.columns]
+    # Reorder rows on the narrow sales frame, so chunks come out in final order
+    sort_keys = [k for k in ['date', 'warengruppe', 'id'] if k in umsatz.columns]
+    if 'warengruppe' in umsatz.columns:
+        # few distinct groups: sort on the small category codes
+        umsatz['warengruppe'] = umsatz['warengruppe'].astype('category')
     if sort_keys:
-        merged = merged.sort_values(by=sort_keys, na_position='last')
-
-    # Column order
-    preferred = ['date', 'warengruppe', 'id', 'umsatz',
-                 'Bewoelkung', 'Temperatur', 'Windgeschwindigkeit', 'Wettercode',
-                 'KielerWoche', 'school_holiday', 'public_holiday']
-    cols_order = [c for c in preferred if c in merged.columns] + \
-                 [c for c in merged.columns if c not in preferred]
-    merged = merged[cols_order]
+        umsatz = umsatz.sort_values(by=sort_keys, kind='mergesort')
+    umsatz = add_date_key(umsatz)
 
     ANALYSIS_DIR.mkdir(parents=True, exist_ok=True)
-    out_path = ANALYSIS_DIR / 'merged_data_updated.csv'
 
-    merged.to_csv(out_path, index=False, na_rep='NaN')
+    # widen and write SALES_CHUNK_ROWS rows at a time; at least one (maybe empty)
+    # chunk so the header is always written
+    chunks = (merge_features(umsatz.iloc[i:i + SALES_CHUNK_ROWS], first_key, day_table,
+                             school_dates, public_dates)
+              for i in range(0, max(len(umsatz), 1), SALES_CHUNK_ROWS))
+    # Parquet copy for downstream reloads: typed, columnar, no text parsing
+    write_csv_chunks(chunks, out_path, parquet_path=parquet_path)
 
-    print(f'Wrote updated merged CSV to: {out_path} (rows: {len(merged)})')
+    print(f'Wrote updated merged CSV to: {out_path} (rows: {len(umsatz)})')
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Merge sales with weather, kiwo and holiday data.')
+    parser.add_argument('--force', action='store_true',
+                        help='rebuild the output even if it is newer than all inputs')
+    args = parser.parse_args()
     try:
-        main()
+        main(force=args.force)
     except Exception as e:
         print('Error during merge:', e, file=sys.stderr)
         raise